@@ -318,7 +318,7 @@ def multi_head_attention_forward(
     # compute in-projection
     #
     if not use_separate_proj_weight:
-        q, k, v = _in_projection_packed(query, key, value, in_proj_weight.half(), in_proj_bias.half())
+        q, k, v = _in_projection_packed(query, key, value, in_proj_weight.to(query.dtype), in_proj_bias.to(query.dtype))
     else:
         assert q_proj_weight is not None, "use_separate_proj_weight is True but q_proj_weight is None"
         assert k_proj_weight is not None, "use_separate_proj_weight is True but k_proj_weight is None"
@@ -431,7 +431,12 @@ def multi_head_attention_forward(
     #
     # (deep breath) calculate attention and out projection
     #
-    attn_output, attn_output_weights = _scaled_dot_product_attention(q, k, v, bsz, num_heads, attn_sp, attn_mask, dropout_p)
+    if not need_weights and hasattr(F, "scaled_dot_product_attention"):
+        # fused kernel (FlashAttention / memory-efficient), the S x S weights are never materialized
+        attn_output = _fused_scaled_dot_product_attention(q, k, v, bsz, num_heads, attn_sp, attn_mask, dropout_p)
+        attn_output_weights = None
+    else:
+        attn_output, attn_output_weights = _scaled_dot_product_attention(q, k, v, bsz, num_heads, attn_sp, attn_mask, dropout_p)
     attn_output = attn_output.transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
     attn_output = linear(attn_output, out_proj_weight, out_proj_bias)
 
@@ -500,6 +505,52 @@ def _scaled_dot_product_attention(
     output = torch.bmm(attn, v)
     return output, attn
 
+def _fused_scaled_dot_product_attention(
+    q: Tensor,
+    k: Tensor,
+    v: Tensor,
+    bsz: int,
+    num_heads: int,
+    attn_sp: Optional[Tensor] = None,
+    attn_mask: Optional[Tensor] = None,
+    dropout_p: float = 0.0,
+) -> Tensor:
+    r"""
+    Same computation as :func:`_scaled_dot_product_attention`, dispatched to
+    ``torch.nn.functional.scaled_dot_product_attention``. The per-sample
+    attention prior ``attn_sp`` and ``attn_mask`` are folded into a single
+    additive bias. Only the attended values are returned.
+
+    Shape:
+        - q: :math:`(B, Nt, E)`, k, v: :math:`(B, Ns, E)` where B is ``bsz * num_heads``.
+        - attn_sp: :math:`(bsz, Nt, Ns)`.
+        - attn_mask: either a 3D tensor of shape :math:`(B, Nt, Ns)` or :math:`(1, Nt, Ns)`.
+
+        - Output: :math:`(B, Nt, E)`
+    """
+    _, Nt, E = q.shape
+    Ns = k.shape[1]
+    q = q.view(bsz, num_heads, Nt, E)
+    k = k.view(bsz, num_heads, Ns, E)
+    v = v.view(bsz, num_heads, Ns, E)
+
+    attn_bias = None
+    if attn_mask is not None:
+        if attn_mask.size(0) == 1:
+            attn_bias = attn_mask.view(1, 1, Nt, Ns)
+        else:
+            attn_bias = attn_mask.view(bsz, num_heads, Nt, Ns)
+    if attn_sp is not None:
+        attn_sp = attn_sp.unsqueeze(1)
+        attn_bias = attn_sp if attn_bias is None else attn_sp + attn_bias
+    if attn_bias is not None:
+        attn_bias = attn_bias.to(q.dtype)
+
+    output = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias, dropout_p=dropout_p)
+    # the memory-efficient backend returns a non-contiguous (transposed) buffer, so view() is not always possible
+    return output.reshape(bsz * num_heads, Nt, E)
+
+
 def softmax(input: Tensor, dim: Optional[int] = None, _stacklevel: int = 3, dtype: Optional[int] = None) -> Tensor:
     r"""Applies a softmax function.
 
@@ -91,7 +91,9 @@ def extend_cfg(cfg):
     cfg.TRAINER.DAM.N_VPRO = 2  # number of prompt vectors
     cfg.TRAINER.DAM.N_SET = 5
     cfg.DATASET.GPT_DIR = './'
-    cfg.TRAINER.DAM.PREC = "fp16"  # fp16, fp32, amp
+    cfg.TRAINER.DAM.PREC = "fp16"  # fp16, fp32, amp, bf16
+    cfg.TRAINER.DAM.GRAD_CKPT = False  # gradient checkpointing for the prompted encoders (trades compute for memory)
+    cfg.TRAINER.DAM.COMPILE = False  # torch.compile the whole model (requires torch>=2.2)
     cfg.DATASET.SUBSAMPLE_CLASSES = "all"  # all, base or new
     cfg.DATASET.ID = 0
 
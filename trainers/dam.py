@@ -1,7 +1,10 @@
 import os.path as osp
 
+import inspect
 import json
+import math
 import random
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
@@ -15,6 +18,9 @@ from dassl.optim import build_optimizer, build_lr_scheduler
 from clip import clip
 import torch.utils.checkpoint as checkpoint
 
+# 'use_reentrant' is only accepted by checkpoint() from torch 1.11 on
+CKPT_KWARGS = {"use_reentrant": False} if "use_reentrant" in inspect.signature(checkpoint.checkpoint).parameters else {}
+
 def load_clip_to_cpu(cfg):
     backbone_name = cfg.MODEL.BACKBONE.NAME
     url = clip._MODELS[backbone_name]
@@ -43,12 +49,11 @@ class VisionEncoderZS(nn.Module):
         self.ln_post = visual.ln_post
         self.proj = visual.proj
         self.dtype = clip_model.dtype
-        self.conv1 = clip_model.visual.conv1
         self.class_embedding = clip_model.visual.class_embedding
         self.positional_embedding = clip_model.visual.positional_embedding
 
     def forward(self, x):
-        x = self.conv1(x)
+        # x: patch embeddings from conv1, (B, width, grid, grid)
         x = x.reshape(x.shape[0], x.shape[1], -1)
         x = x.permute(0, 2, 1)
 
@@ -76,16 +81,22 @@ class VisionEncoder(nn.Module):
         self.proj = visual.proj
         self.dtype = clip_model.dtype
         self.n_vpro = cfg.TRAINER.DAM.N_VPRO # prompt length
+        self.grad_ckpt = cfg.TRAINER.DAM.GRAD_CKPT # recompute activations of each block in backward
 
     def forward(self, x, p_visual):
         x = self.ln_pre(x).type(self.dtype)
         x = x.permute(1, 0, 2)
 
+        use_ckpt = self.grad_ckpt and self.training and torch.is_grad_enabled()
+
         for layer_idx, layer in enumerate(self.transformer):
             if layer_idx > 0:
                 # insert layer-wise global visual prompt
-                x[-self.n_vpro:] = p_visual[layer_idx-1].unsqueeze(1).expand(-1, x.shape[1], -1)
-            x = layer(x)
+                x[-self.n_vpro:] = p_visual[layer_idx-1, :, None, :].expand(-1, x.shape[1], -1)
+            if use_ckpt:
+                x = checkpoint.checkpoint(layer, x, **CKPT_KWARGS)
+            else:
+                x = layer(x)
             
         x = x.permute(1, 0, 2)
         x = self.ln_post(x[:, 0, :])
@@ -105,18 +116,15 @@ class VisionPromptLearner(nn.Module):
         self.positional_embedding = clip_model.visual.positional_embedding
         self.layers = len(clip_model.visual.transformer.resblocks)
         # global prompt for image encoder (except for the first layer)
-        self.p_visual = nn.ParameterList([nn.Parameter(torch.empty(self.n_vpro, self.pro_dim).type(self.dtype))
-                                          for _ in range(self.layers-1)])
-        for p in self.p_visual:
-            nn.init.normal_(p, std=0.02)
+        self.p_visual = nn.Parameter(torch.empty(self.layers-1, self.n_vpro, self.pro_dim).type(self.dtype)) # (L-1, n_vpro, D)
+        nn.init.normal_(self.p_visual, std=0.02)
             
         # global prompt for the first layer of image encoder
         self.p_input = nn.Parameter(torch.empty(self.n_vpro, self.pro_dim))
         nn.init.normal_(self.p_input, std=0.02)
 
     def forward(self, x):
-        x = x.type(self.dtype)
-        x = self.conv1(x)
+        # x: patch embeddings from conv1, (B, width, grid, grid)
         x = x.reshape(x.shape[0], x.shape[1], -1)
         x = x.permute(0, 2, 1)
         x = torch.cat([self.class_embedding.to(x.dtype) + torch.zeros(x.shape[0], 1, x.shape[-1], 
@@ -145,15 +153,16 @@ class TextEncoderZS(nn.Module):
         x = x + self.positional_embedding.type(self.dtype)
         x = x.permute(1, 0, 2)
         
+        eos_idx = text.argmax(dim=-1) # position of the EOS token
         feats = []
         for _, layer in enumerate(self.transformer):
             x = layer(x)
             # save class embeddings from different layers
-            feats.append(x[text.argmax(dim=-1), torch.arange(x.shape[1])])
+            feats.append(x[eos_idx, torch.arange(x.shape[1], device=x.device)])
 
         x = x.permute(1, 0, 2)
         x = self.ln_final(x)
-        x = x[torch.arange(x.shape[0]), text.argmax(dim=-1)] @ self.text_projection
+        x = x[torch.arange(x.shape[0], device=x.device), eos_idx] @ self.text_projection
         txt_feats = torch.stack(feats)
 
         return x, txt_feats
@@ -169,10 +178,12 @@ class TextEncoder(nn.Module):
         self.dtype = clip_model.dtype
         self.n_tpro = cfg.TRAINER.DAM.N_TPRO # prompt length
         self.n_set = cfg.TRAINER.DAM.N_SET # number of descriptions for each category
+        self.grad_ckpt = cfg.TRAINER.DAM.GRAD_CKPT # recompute activations of each block in backward
 
-    def forward(self, x, p_ins, p_uni, tokenized_prompts, attn, flag):
+    def forward(self, x, p_ins, p_uni, eos_idx, attn, flag):
         # p_ins: instance-specific prompt, a.k.a high-level prompt from descriptions
         # p_uni: task-unified prompt, a.k.a global-level prompt
+        # eos_idx: position of the EOS token of each prompt
         # flag: True when training and False when testing
         # Since we use all (self.n_set) descriptions for learning high-level prompt, we should reshape p_ins first.
         (l, c, d) = p_ins.shape
@@ -180,37 +191,33 @@ class TextEncoder(nn.Module):
 
         # During evaluation, we leverage all (n_set) structures according to descriptions for modeling one category (N*C*n_set steps in total), 
         # instead of randomly picking one structure for each category (N*C steps in one epoch). 
-        if not flag:
-            p_ins = p_ins.unsqueeze(2).expand(-1, -1, self.n_set, -1, -1)
-            p_ins = torch.flatten(p_ins, 1, 2) # (L, C*n_set, n_set, D)
-            
-        p_ins = p_ins.permute(0, 2, 1, 3).type(self.dtype)
+        # The sequences of a category are contiguous in the batch, so p_ins is broadcast over them when written into x
+        # rather than being repeated n_set times here.
+        p_ins = p_ins.permute(0, 2, 1, 3).type(self.dtype) # (L, n_set, C, D)
+        n_cls = p_ins.shape[2]
         x = (x + self.positional_embedding).type(self.dtype)
         x = x.permute(1, 0, 2)
+        use_ckpt = self.grad_ckpt and self.training and torch.is_grad_enabled()
 
         for layer_idx, layer in enumerate(self.transformer):
-            if layer_idx > 0:                
-                prefix = x[:1]
-                suffix = x[1+self.n_tpro+self.n_set:]
-                
+            if layer_idx > 0:
+                # The layout [prefix | ctx_g | ctx_h | suffix] is fixed, so the prompts are written into their slots in place.
                 # global-level prompt
-                ctx_g = p_uni[layer_idx - 1].unsqueeze(1).expand(self.n_tpro, prefix.shape[1], -1)
+                x[1:1+self.n_tpro] = p_uni[layer_idx - 1, :, None, :].expand(-1, x.shape[1], -1)
                 
                 # high-level prompt
-                ctx_h = p_ins[layer_idx - 1]
-                x = torch.cat([prefix, ctx_g, ctx_h, suffix], dim=0)
+                x[1+self.n_tpro:1+self.n_tpro+self.n_set].unflatten(1, (n_cls, x.shape[1] // n_cls)).copy_(p_ins[layer_idx - 1].unsqueeze(2))
                 
-                # 'attn' is attention matrix from topological prompt learner, 
-                # considering as low-level prompt which models relationships in an explicit way.
-                x = layer(x, attn[:, layer_idx])
-            elif layer_idx == 0:
-                x = layer(x, attn[:, layer_idx])
+            # 'attn' is attention matrix from topological prompt learner, 
+            # considering as low-level prompt which models relationships in an explicit way.
+            if use_ckpt:
+                x = checkpoint.checkpoint(layer, x, attn[:, layer_idx], **CKPT_KWARGS)
             else:
-                x = layer(x)
+                x = layer(x, attn[:, layer_idx])
 
         x = x.permute(1, 0, 2)
         x = self.ln_final(x)
-        x = x[torch.arange(x.shape[0]), tokenized_prompts.argmax(dim=-1)] @ self.text_projection
+        x = x[torch.arange(x.shape[0], device=x.device), eos_idx] @ self.text_projection
         
         if not flag:
             x = x.reshape(x.shape[0]//5, 5, -1)
@@ -228,10 +235,8 @@ class PromptLearner(nn.Module):
         self.layers = len(clip_model.transformer.resblocks)
 
         # global prompt for text encoder (except for the first layer)
-        self.p_uni = nn.ParameterList([nn.Parameter(torch.empty(self.n_tpro, self.ctx_dim).type(self.dtype))
-                                                      for _ in range(self.layers - 1)])
-        for p in self.p_uni:
-            nn.init.normal_(p, std=0.02)
+        self.p_uni = nn.Parameter(torch.empty(self.layers - 1, self.n_tpro, self.ctx_dim).type(self.dtype)) # (L-1, n_tpro, D)
+        nn.init.normal_(self.p_uni, std=0.02)
             
         # projector for learning high-level prompt (a.k.a p_ins)
         self.p_ins_projector = nn.Linear(self.ctx_dim, self.ctx_dim)
@@ -244,36 +249,42 @@ class PromptLearner(nn.Module):
         self.info_topo = info_topo # topological structure in a dictionary form
         self.n_cls = len(classnames)
         self.clip_model = clip_model
-    def forward(self, feats, attns, flag):
-        p_uni = self.p_uni
-        prompts, attn = [], []
-        prompt_prefix = " ".join(["X"] * (self.n_tpro+self.n_set))
 
-        if flag:
-            for name in self.classnames:
-                # For efficiency, we randomly pick one structure as a part of input during training, 
-                # while leveraging all descriptions of the category for learning high-level prompt.
-                id = random.randint(0, self.n_set-1)
+        # The prompts of all (classname, id) pairs are fixed, so we tokenize and embed them once here.
+        prompt_prefix = " ".join(["X"] * (self.n_tpro+self.n_set))
+        prompts = []
+        for name in self.classnames:
+            for id in range(self.n_set):
                 topo = self.info_topo[name][id]
                 p = prompt_prefix + " " + name + ". " + ", ".join(topo['Entities']) + ". " + ", ".join(topo['Attributes']) + "."
-                attn.append(attns[name][:, id])
                 prompts.append(p)
-        else:
-            for name in self.classnames:
-                # We leverage all structures from descriptions as a part of input respectively during evaluation.
-                for id in range(self.n_set):
-                    topo = self.info_topo[name][id]
-                    p = prompt_prefix + " " + name + ". " + ", ".join(topo['Entities']) + ". "  + ", ".join(topo['Attributes']) + "." 
-                    attn.append(attns[name][:, id])
-                    prompts.append(p)
-        
-        attn = torch.stack(attn, dim=0)
-            
-        self.tokenized_prompts = torch.cat([clip.tokenize(p, truncate=True) for p in prompts]).cuda()  # (n_cls, n_tkn)
+        all_tokenized = clip.tokenize(prompts, truncate=True).view(self.n_cls, self.n_set, -1)
+        all_tokenized = all_tokenized.to(clip_model.token_embedding.weight.device)
         with torch.no_grad():
-            embedding = self.clip_model.token_embedding(self.tokenized_prompts).type(self.dtype)
+            all_embeddings = clip_model.token_embedding(all_tokenized).type(self.dtype)
+        self.register_buffer("all_eos", all_tokenized.argmax(dim=-1), persistent=False) # (n_cls, n_set)
+        self.register_buffer("all_embeddings", all_embeddings, persistent=False) # (n_cls, n_set, n_tkn, D)
+
+    def forward(self, feats, attns, flag):
+        p_uni = self.p_uni
+
+        if flag:
+            # For efficiency, we randomly pick one structure as a part of input during training, 
+            # while leveraging all descriptions of the category for learning high-level prompt.
+            # the ids are drawn on the host and copied from pinned memory, so the copy does not block
+            ids = torch.tensor([random.randint(0, self.n_set-1) for _ in self.classnames])
+            ids = ids.pin_memory().to(self.all_eos.device, non_blocking=True)
+            cls_idx = torch.arange(self.n_cls, device=self.all_eos.device)
+            attn = attns[cls_idx, ids] # (n_cls, L, T, T)
+            self.eos_idx = self.all_eos[cls_idx, ids] # (n_cls,)
+            embedding = self.all_embeddings[cls_idx, ids]
+        else:
+            # We leverage all structures from descriptions as a part of input respectively during evaluation.
+            attn = attns.flatten(0, 1) # (n_cls*n_set, L, T, T)
+            self.eos_idx = self.all_eos.flatten() # (n_cls*n_set,)
+            embedding = self.all_embeddings.flatten(0, 1)
         
-        p_input = self.p_input.unsqueeze(0).expand(len(prompts), -1, -1)
+        p_input = self.p_input.unsqueeze(0).expand(len(embedding), -1, -1)
         prefix = embedding[:, :1]
         suffix = embedding[:, 1+self.n_tpro+self.n_set:]
         
@@ -281,14 +292,9 @@ class PromptLearner(nn.Module):
         p_ori = torch.cat([prefix, p_input, suffix], dim=1)
 
         # generate corresponding high-level prompt (p_ins)
-        p_ins = []
         (l, c, n, d) = feats.shape
-        feats = feats.reshape(l, c*n, d)
-        for idx in range(self.layers - 1):
-            feat = feats[idx].float()
-            feat = feat + self.p_ins_projector(feat) 
-            p_ins.append(feat)
-        p_ins = torch.stack(p_ins, dim=0)
+        feats = feats.reshape(l, c*n, d)[:self.layers - 1].float() # (L-1, C*n_set, D)
+        p_ins = feats + self.p_ins_projector(feats)
 
         return p_ori, p_ins, p_uni, attn
 
@@ -307,28 +313,33 @@ class TopoPromptLearner(nn.Module):
         self.e2e_scal = nn.Parameter(torch.zeros(self.layers, 1, 1, 1)) 
         self.e2a_scal = nn.Parameter(torch.zeros(self.layers, 1, 1, 1))
         
-        self.attns_e2e = {classname: [] for classname in classnames}
-        self.attns_e2a = {classname: [] for classname in classnames}
-
         prompt_prefix = " ".join(["X"] * (self.n_tpro + self.n_set))
 
-        for classname in classnames:
+        # generate texts with classname, entities and attributes for all (classname, id) pairs
+        txts = [self.generate_text(classname, prompt_prefix, prompt_topo[classname][id])
+                for classname in classnames for id in range(self.n_set)]
+        tokens_all = clip.tokenize(txts, truncate=True).view(len(classnames), self.n_set, -1)
+        n_tokens = tokens_all.shape[-1]
+
+        # attention matrices of all categories are built on CPU and moved to GPU at once
+        attns_e2e = torch.zeros(len(classnames), self.n_set, n_tokens, n_tokens, dtype=torch.float16)
+        attns_e2a = torch.zeros(len(classnames), self.n_set, n_tokens, n_tokens, dtype=torch.float16)
+
+        for cls_idx, classname in enumerate(classnames):
             topos = prompt_topo[classname]
             for id in range(self.n_set):
-                # generate text with classname, entities and attributes
-                txt = self.generate_text(classname, prompt_prefix, topos[id])
-                tokens = clip.tokenize(txt, truncate=True)[0]
-                
+                tokens = tokens_all[cls_idx, id]
+
                 # generate pair-wise relationships
                 e2e, e2a = self.extract_relationships(tokens, topos[id])
 
                 # create attention matrix based on pair-wise relationships
-                attn_e2e = self.create_attention_matrix(tokens, e2e)
-                attn_e2a = self.create_attention_matrix(tokens, e2a)
+                self.create_attention_matrix(attns_e2e[cls_idx, id], e2e)
+                self.create_attention_matrix(attns_e2a[cls_idx, id], e2a)
 
-                # save attention matrices
-                self.attns_e2e[classname].append(attn_e2e)
-                self.attns_e2a[classname].append(attn_e2a)
+        # (C, n_set, T, T), copied from pinned memory so that the transfer does not block the host
+        self.register_buffer("attns_e2e", attns_e2e.pin_memory().cuda(non_blocking=True), persistent=False)
+        self.register_buffer("attns_e2a", attns_e2a.pin_memory().cuda(non_blocking=True), persistent=False)
 
     # generate text with classname, entities and attributes
     def generate_text(self, classname, prompt_prefix, topo):
@@ -357,18 +368,11 @@ class TopoPromptLearner(nn.Module):
 
         return e2e, e2a
 
-    # create attention matrix based on pair-wise relationships
-    def create_attention_matrix(self, tokens, relationships):
-        n_tokens = len(tokens)
-        attn = torch.zeros(n_tokens, n_tokens).cuda()
-
+    # fill attention matrix (T, T) in place based on pair-wise relationships
+    def create_attention_matrix(self, attn, relationships):
         for e in relationships:
-            d11 = torch.tensor([[i] for i in e[0]]).type(torch.long)
-            d21 = torch.tensor([e[1] for _ in range(len(e[0]))]).type(torch.long)
-            d12 = torch.tensor([[i] for i in e[1]]).type(torch.long)
-            d22 = torch.tensor([e[0] for _ in range(len(e[1]))]).type(torch.long)
-            attn[d11, d21] += 1
-            attn[d12, d22] += 1
+            attn[np.ix_(e[0], e[1])] += 1
+            attn[np.ix_(e[1], e[0])] += 1
 
         return attn
 
@@ -384,23 +388,19 @@ class TopoPromptLearner(nn.Module):
         return []
 
     def forward(self):
-        attns = {}
-        for classname in self.classnames:
-            classname = classname.replace("_", " ")
-            # weight generated matrices with two learnable scalars
-            attns[classname] = self.e2e_scal * torch.stack(self.attns_e2e[classname]).cuda() + \
-                               self.e2a_scal * torch.stack(self.attns_e2a[classname]).cuda()
+        # weight generated matrices of all categories with two learnable scalars at once
+        attns = self.e2e_scal.view(-1, 1, 1) * self.attns_e2e.unsqueeze(2) + \
+                self.e2a_scal.view(-1, 1, 1) * self.attns_e2a.unsqueeze(2) # (C, n_set, L, T, T)
         return attns
 
 class CrossModalAlignment(nn.Module):
     # img_f: B, K, 512
     # text_f: N, K, 512
     # K=1.
-    # When self.cfg.XD is True (indicating cross-dataset or domain generalization tasks).
-    # To address the computational burden caused by utilizing all categories in 
-    # cross-dataset and domain generalization tasks, 
-    # we have segmented the computation of W_T into "number_class // chunk_size" parts. 
-    # This partitioning allows for individual calculations, thereby reducing computational costs.
+    # Both ridge regressions are solved in the K x K space with the push-through identity
+    # (X^T X + lam E)^-1 X^T = X^T (X X^T + lam E)^-1, and the projected features are computed
+    # as (I A) T (resp. (T A) I) instead of I (A T). No 512 x 512 matrix is formed per image or category,
+    # which keeps cross-dataset and domain generalization tasks (utilizing all categories) tractable.
     
     def __init__(self, cfg):
         super().__init__()
@@ -410,7 +410,7 @@ class CrossModalAlignment(nn.Module):
         self.logits_scales = nn.Parameter(torch.FloatTensor([0.5]))
         self.cfg = cfg
         
-    def get_rc_dist_ItoT(self, img_f, text_f, alpha, beta, chunk_size):
+    def get_rc_dist_ItoT(self, img_f, text_f, alpha, beta):
         B, K, N, d = img_f.shape[0], img_f.shape[1], text_f.shape[0], text_f.shape[-1]
 
         I = img_f.float()   # (B, K, 512)
@@ -420,36 +420,24 @@ class CrossModalAlignment(nn.Module):
         lam = reg * alpha.exp() + 1e-6
         rho = beta.exp().float()
        
-        It = I.permute(0, 2, 1)     # (B, 512, K)
+        M = I.matmul(I.transpose(1, 2))      # (B, K, K)
+        M.diagonal(dim1=-2, dim2=-1).add_(lam)
+        A = torch.linalg.solve(M, I).transpose(1, 2)     # (B, 512, K)
 
-        ItI = It.matmul(I)      # (B, 512, 512)
-        M_inv = (ItI + torch.eye(ItI.size(-1)).to(ItI.device).unsqueeze(0).mul(lam)).inverse()      # (B, 512, 512)
-        A = M_inv.matmul(It) 
+        # T_bar = rho * I A T. With C = rho * I A - E, ||T_bar - T||^2 = <C^T C, T T^T>.
+        C = I.matmul(A).mul(rho)    # (B, K, K)
+        C.diagonal(dim1=-2, dim2=-1).sub_(1)
+        G = C.transpose(1, 2).matmul(C)     # (B, K, K)
+        S = T.matmul(T.transpose(1, 2))     # (N, K, K)
+        dist = G.flatten(1).matmul(S.flatten(1).t()).neg().div(K)    # (B, N)
 
         if self.cfg.XD:
-            dist = torch.zeros((B, N)).to(I.device)
-            for i in range(0, N, chunk_size):
-                with torch.no_grad():
-                    T_chunk = T[i:i+chunk_size]  # (chunk_size, K, 512)
-                    T_expanded = T_chunk.unsqueeze(0)  # (1, chunk_size, K, 512)
-                    W_chunk = A.unsqueeze(1).matmul(T_expanded)  # (B, chunk_size, 512, 512)
-
-                    T_bar_chunk = I.unsqueeze(1).matmul(W_chunk).mul(rho)  # (B, chunk_size, 1, 512)
-                    dist_chunk = (T_bar_chunk - T_chunk.unsqueeze(0)).pow(2).sum(dim=-1).neg().view(B, T_bar_chunk.size(1), K).mean(dim=-1)  # (B, chunk_size)
-
-                    dist[:, i:i+chunk_size] = dist_chunk
-        else:
-            A_expanded = A.unsqueeze(1)     # (B, 1, c, 1)
-            T_expanded = T.unsqueeze(0)     # (1, N, 1, c)
-            
-            W = A_expanded.matmul(T_expanded) # (B, N, c, c)
-
-            T_bar = I.unsqueeze(1).matmul(W).mul(rho) # (B, N, 1, 512)
-            dist = (T_bar - T.unsqueeze(0)).pow(2).sum(dim=-1).neg().view(B, N, K).mean(dim=-1) # (B, N)
+            # no gradient flows through this direction in XD tasks
+            dist = dist.detach()
         
         return dist
     
-    def get_rc_dist_TtoI(self, img_f, text_f, alpha, beta, chunk_size):
+    def get_rc_dist_TtoI(self, img_f, text_f, alpha, beta):
         B, K, N, d = img_f.shape[0], img_f.shape[1], text_f.shape[0], img_f.shape[-1]
 
         I = img_f.float() # (B, 1, 512)
@@ -459,44 +447,28 @@ class CrossModalAlignment(nn.Module):
         lam = reg * alpha.exp() + 1e-6
         rho = beta.exp().float()
 
-        if self.cfg.XD:
-            dist = torch.zeros((N, B)).to(I.device)
-            for i in range(0, N, chunk_size):
-                with torch.no_grad():
-                    T_chunk = T[i:i+chunk_size]  # (chunk_size, 1, 512)
-                    Tt = T_chunk.permute(0, 2, 1) # (chunk_size, 512, 1)
-                    TtT = Tt.matmul(T_chunk) # (chunk_size, 512, 512)
-
-                M_inv = (TtT + torch.eye(TtT.size(-1)).to(TtT.device).unsqueeze(0).mul(lam)).inverse() # (chunk_size, 512, 512)
-                
-                with torch.no_grad():
-                    A = M_inv.matmul(Tt)
-
-                    A_expanded = A.unsqueeze(1)     # (chunk_size, 1, c, 1)
-                    I_expanded = I.unsqueeze(0)     # (1, B, 1, c)
-
-                    W = A_expanded.matmul(I_expanded) # (chunk_size, B, c, c)
+        M = T.matmul(T.transpose(1, 2)) # (N, K, K)
+        M.diagonal(dim1=-2, dim2=-1).add_(lam)
 
-                I_bar = T_chunk.unsqueeze(1).matmul(W).mul(rho) # (chunk_size, B, 1, 512)
-                dist_chunk = (I_bar - I.unsqueeze(0)).pow(2).sum(dim=-1).neg().view(I_bar.size(0), B, K).mean(dim=-1).t() # (B, chunk_size)
-                dist[i:i+chunk_size] = dist_chunk.t() # (chunk_size, B)
-
-            dist = dist.t() # (B, N)
+        if self.cfg.XD:
+            # the reconstruction T A I is treated as a constant in XD tasks; only rho and the '- I' term get gradients
+            with torch.no_grad():
+                A = torch.linalg.solve(M, T).transpose(1, 2) # (N, 512, K)
+            S = T.detach()
+            J = I.detach()
         
         else: 
-            Tt = T.permute(0, 2, 1) # (N, 512, 1)
-
-            TtT = Tt.matmul(T) # (N, 512, 512)
-            M_inv = (TtT + torch.eye(TtT.size(-1)).to(TtT.device).unsqueeze(0).mul(lam)).inverse() # (N, 512, 512)
-            A = M_inv.matmul(Tt)
-
-            A_expanded = A.unsqueeze(1)     # (N, 1, c, 1)
-            I_expanded = I.unsqueeze(0)     # (1, B, 1, c)
-
-            W = A_expanded.matmul(I_expanded) # (N, B, c, c)
-
-            I_bar = T.unsqueeze(1).matmul(W).mul(rho) # (B, N, 1, 512)
-            dist = (I_bar - I.unsqueeze(0)).pow(2).sum(dim=-1).neg().view(N, B, K).mean(dim=-1).t()
+            A = torch.linalg.solve(M, T).transpose(1, 2) # (N, 512, K)
+            S = T
+            J = I
+
+        # I_bar = rho * T A I = V J with V = rho * T A.
+        # ||V J - I||^2 = <V^T V, J J^T> - 2 <V, I J^T> + <E, I I^T>
+        V = S.matmul(A).mul(rho) # (N, K, K)
+        dist = V.transpose(1, 2).matmul(V).flatten(1).matmul(J.matmul(J.transpose(1, 2)).flatten(1).t()) \
+               - 2 * V.flatten(1).matmul(I.matmul(J.transpose(1, 2)).flatten(1).t()) \
+               + I.pow(2).sum(dim=(1, 2)).unsqueeze(0) # (N, B)
+        dist = dist.neg().div(K).t() # (B, N)
 
         return dist
     
@@ -504,10 +476,9 @@ class CrossModalAlignment(nn.Module):
         alpha_ItoT, alpha_TtoI = self.r[0], self.r[2]
         beta_ItoT, beta_TtoI = self.r[1], self.r[3]  
         alp = self.alp
-        chunk_size = 100
 
-        rc_dist_ItoT = self.get_rc_dist_ItoT(img_f, text_f, alpha_ItoT, beta_ItoT, chunk_size)
-        rc_dist_TtoI = self.get_rc_dist_TtoI(img_f, text_f, alpha_TtoI, beta_TtoI, chunk_size)
+        rc_dist_ItoT = self.get_rc_dist_ItoT(img_f, text_f, alpha_ItoT, beta_ItoT)
+        rc_dist_TtoI = self.get_rc_dist_TtoI(img_f, text_f, alpha_TtoI, beta_TtoI)
         rc_dist = alp * rc_dist_ItoT + (1 - alp) * rc_dist_TtoI
 
         logits = rc_dist*self.scale
@@ -533,8 +504,9 @@ class text_xd_SameModalAlignment(nn.Module):
 
         St = S.t()  # (512, N)
         StS = St.matmul(S)  # (512, 512)
-        M_inv = (StS + torch.eye(StS.size(-1)).to(StS.device).mul(lam)).inverse()  # (512, 512)
-        W = M_inv.matmul(St).matmul(T)  # (512, 512)
+        StS.diagonal(dim1=-2, dim2=-1).add_(lam)
+        L = torch.linalg.cholesky(StS)  # (512, 512)
+        W = torch.cholesky_solve(St, L).matmul(T)  # (512, 512)
 
         return W
 
@@ -542,8 +514,9 @@ class text_xd_SameModalAlignment(nn.Module):
 
         alpha = self.alpha
         W = self.get_align_dist(source, target, alpha)
-        identity = torch.eye(W.size(0)).to(W.device)
-        W = W - (W - identity) * self.beta
+        # W - (W - E) * beta
+        W = W * (1 - self.beta)
+        W.diagonal(dim1=-2, dim2=-1).add_(self.beta)
 
         return W
     
@@ -564,19 +537,20 @@ class SameModalAlignment(nn.Module):
 
         St = S.permute(0, 2, 1)  # (B, 512, 1)
         StS = St.matmul(S)  # (B, 512, 512)
-        M_inv = (StS + torch.eye(StS.size(-1)).to(StS.device).mul(lam)).inverse()  # (B, 512, 512)
-        W = M_inv.matmul(St).matmul(T)  # (B, 512, 512)
+        StS.diagonal(dim1=-2, dim2=-1).add_(lam)
+        L = torch.linalg.cholesky(StS)  # (B, 512, 512)
+        W = torch.cholesky_solve(St, L).matmul(T)  # (B, 512, 512)
 
         return W
     
 
     def forward(self, source, target):
-        B = source.shape[0]
         alpha = self.alpha
 
         W = self.get_align_dist(source, target, alpha)
-        identity = torch.eye(W.size(1)).unsqueeze(0).repeat(B, 1, 1).to(W.device)
-        W = W - (W - identity) * self.beta
+        # W - (W - E) * beta
+        W = W * (1 - self.beta)
+        W.diagonal(dim1=-2, dim2=-1).add_(self.beta)
         
         return W
 
@@ -611,6 +585,9 @@ class CustomCLIP(nn.Module):
         self.dtype = clip_model.dtype
         self.model = clip_model
         self.cfg = cfg
+        self.prec = cfg.TRAINER.DAM.PREC
+        # "amp" uses fp16 autocast with loss scaling by the trainer's GradScaler; "bf16" needs no scaling
+        self.amp_dtype = torch.bfloat16 if self.prec == "bf16" else torch.float16
 
         self.cma = CrossModalAlignment(cfg)
         self.img_sma = SameModalAlignment(cfg)
@@ -619,55 +596,98 @@ class CustomCLIP(nn.Module):
         else:
             self.text_sma = SameModalAlignment(cfg)
         self.flag = True
+        # Evaluation text features are cached only in eager mode: under torch.compile the lookup and the stored
+        # tensor would sit inside the captured CUDA graph, whose outputs are overwritten by the next replay.
+        self.cache_text = not cfg.TRAINER.DAM.COMPILE
+        self._text_features_cache = None
 
         with torch.no_grad():
-            # zs_feats: layer-wise class embeddings from frozen text encoder
-            # zs_repres: final representations from frozen text encoder
-            zs_feats, zs_repres = [], []
-            for classname in classnames:
-                texts = text_prompts[classname]
-                texts = clip.tokenize(texts).cuda()
+            # Encode the descriptions of all categories in a single pass of the frozen text encoder,
+            # then regroup them per category with 'lens'.
+            lens = [len(text_prompts[classname]) for classname in classnames]
+            texts = clip.tokenize([t for classname in classnames for t in text_prompts[classname]]).cuda()
+            # the frozen encoder never backpropagates, so it runs in half precision and its outputs are cast back to fp32
+            with torch.autocast(device_type="cuda", dtype=self.amp_dtype):
                 class_embeddings, features = self.text_encoder_zs(texts)
-                class_embeddings /= class_embeddings.norm(dim=-1, keepdim=True)
-                class_embedding = class_embeddings.mean(dim=0)
-                class_embedding /= class_embedding.norm()
-                features /= features.norm(dim=-1, keepdim=True)
-                zs_feats.append(features)
-                zs_repres.append(class_embedding)
-            self.text_features_zs = torch.stack(zs_repres, dim=1).cuda()
-            self.text_features_ft = torch.stack(zs_feats, dim=1).cuda()
+            class_embeddings, features = class_embeddings.float(), features.float()
+
+            # zs_repres: final representations from frozen text encoder
+            class_embeddings /= class_embeddings.norm(dim=-1, keepdim=True)
+            class_ids = torch.repeat_interleave(torch.arange(len(lens), device=texts.device),
+                                                torch.tensor(lens, device=texts.device))
+            zs_repres = torch.zeros(len(lens), class_embeddings.shape[-1],
+                                    dtype=class_embeddings.dtype, device=class_embeddings.device)
+            zs_repres.index_add_(0, class_ids, class_embeddings)
+            zs_repres /= zs_repres.norm(dim=-1, keepdim=True)
+
+            # zs_feats: layer-wise class embeddings from frozen text encoder
+            features /= features.norm(dim=-1, keepdim=True)
+            zs_feats = features.split(lens, dim=1)
+
+            # The frozen text features are computed once and kept as buffers, so they follow the module across devices
+            # without being written to checkpoints.
+            self.register_buffer("text_features_zs", zs_repres.t().contiguous(), persistent=False)    # D N
+            # the same unit-normalized features in row-major layout, consumed row-wise by SMA and the SMR loss
+            self.register_buffer("text_features_zs_n", zs_repres, persistent=False)    # N D
+            self.register_buffer("text_features_ft", torch.stack(zs_feats, dim=1), persistent=False)    # L N n_set D
 
         self.image_align_m = cfg.TRAINER.I_M
         self.text_align_m = cfg.TRAINER.T_M
         self.w = cfg.TRAINER.W
         print("image_align_m:", self.image_align_m, "   text_align_m:", self.text_align_m, "   loss_w:", self.w)
 
+    def train(self, mode=True):
+        # the cached evaluation text features are only valid until the parameters may change again
+        self._text_features_cache = None
+        return super().train(mode)
+
     def forward(self, image, image2=None, label=None):
         logit_scale = self.logit_scale.exp()
         
         text_features_zs = self.text_features_zs    # D N
-        if image2 is None:
-            image2 = image
-        image_features_zs = self.image_encoder_zs(image2.type(self.dtype))
-        image_features_zs = image_features_zs / image_features_zs.norm(dim=-1, keepdim=True)    # B D
-        
-        attns = self.topo_prompt_learner()
-        p_ori, p_ins, p_uni, attns = self.prompt_learner(self.text_features_ft, attns, self.training)
+        use_amp = self.prec in ["amp", "bf16"]
 
-        tokenized_prompts = self.prompt_learner.tokenized_prompts
-        text_features = self.text_encoder(p_ori, p_ins, p_uni, tokenized_prompts, attns, self.training)
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-        
-        # Since we use multiple structures for producing representations of one category, 
-        # we should take their mean value as the final representation.
-        if not self.training:
-            text_features = text_features.mean(dim=1)
+        # Both views go through the same frozen patch embedding, so it runs once on the stacked views
+        # (or only once when there is a single view).
+        with torch.no_grad(), torch.autocast(device_type="cuda", dtype=self.amp_dtype, enabled=use_amp):
+            if image2 is None:
+                patches = patches_zs = self.vision_prompt_learner.conv1(image.type(self.dtype))
+            else:
+                patches, patches_zs = self.vision_prompt_learner.conv1(torch.cat([image, image2]).type(self.dtype)).chunk(2)
+
+        # The frozen image encoder never backpropagates, so it always runs in half precision and records no graph.
+        with torch.no_grad(), torch.autocast(device_type="cuda", dtype=self.amp_dtype):
+            image_features_zs = self.image_encoder_zs(patches_zs)
+        image_features_zs = F.normalize(image_features_zs.float(), dim=-1)    # B D
+
+        # The prompted encoders run under autocast when PREC is "amp" or "bf16"; the alignment modules below
+        # solve ridge regressions and stay in fp32.
+        with torch.autocast(device_type="cuda", dtype=self.amp_dtype, enabled=use_amp):
+            # Without training, the text features do not depend on the image batch, so they are computed once.
+            use_cache = self.cache_text and not self.training and not torch.is_grad_enabled()
+            if use_cache and self._text_features_cache is not None:
+                text_features = self._text_features_cache
+            else:
+                attns = self.topo_prompt_learner()
+                p_ori, p_ins, p_uni, attns = self.prompt_learner(self.text_features_ft, attns, self.training)
+
+                eos_idx = self.prompt_learner.eos_idx
+                text_features = self.text_encoder(p_ori, p_ins, p_uni, eos_idx, attns, self.training)
+                text_features = F.normalize(text_features, dim=-1)    # N D
+            
+                # Since we use multiple structures for producing representations of one category, 
+                # we should take their mean value as the final representation.
+                if not self.training:
+                    text_features = F.normalize(text_features.mean(dim=1), dim=-1)
+
+                if use_cache:
+                    self._text_features_cache = text_features
         
-        x, p_visual = self.vision_prompt_learner(image)
-        image_features = self.image_encoder(x, p_visual)
+            x, p_visual = self.vision_prompt_learner(patches)
+            image_features = self.image_encoder(x, p_visual)
 
-        image_features = image_features / image_features.norm(dim=-1, keepdim=True) # B D
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)    # N D
+        # SMA below consumes the normalized prompted features
+        image_features = F.normalize(image_features, dim=-1) # B D
         
         # Unlike the approach outlined in the paper, we transpose the features for text and image, 
         # as described in the paper. We substitute the paper's $f$ with $f^T$, which is equivalent.
@@ -675,18 +695,15 @@ class CustomCLIP(nn.Module):
         x_a = image_features.unsqueeze(1).float().matmul(img_weight).squeeze(1)
 
         if self.cfg.XD:
-            text_weight = self.text_sma(text_features, text_features_zs.t())
+            text_weight = self.text_sma(text_features, self.text_features_zs_n)
             x_b = text_features.float().matmul(text_weight)
         else:
-            text_weight = self.text_sma(text_features.unsqueeze(1), text_features_zs.t().unsqueeze(1))
+            text_weight = self.text_sma(text_features.unsqueeze(1), self.text_features_zs_n.unsqueeze(1))
             x_b = text_features.unsqueeze(1).float().matmul(text_weight).squeeze(1)
 
         
-        image_features = self.image_align_m * x_a + image_features
-        image_features = image_features / image_features.norm(dim=-1, keepdim=True) 
-        
-        text_features = self.text_align_m * x_b + text_features
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+        image_features = F.normalize(self.image_align_m * x_a + image_features, dim=-1)
+        text_features = F.normalize(self.text_align_m * x_b + text_features, dim=-1)
 
         # asymmetric loss
         logits_org = logit_scale * (image_features @ text_features.t())
@@ -697,20 +714,20 @@ class CustomCLIP(nn.Module):
         if self.cfg.CD:
             logits_i = logit_scale * (image_features @ text_features_zs.float())
             logits_t = logit_scale * (image_features_zs.float() @ text_features.t())
-            logits = (logits + logits_i + logits_t)/3
+            # average of the three logits, accumulated into a single new tensor
+            logits = logits.add(logits_i).add_(logits_t).div_(3)
         
 
         if self.training:
-            cos = torch.nn.CosineSimilarity(dim=1,eps=1e-07)
-            score = cos(image_features, image_features_zs)
-            loss_smr_image = 1.0 - torch.mean(score)
-
-            score = cos(text_features, text_features_zs.t())
-            loss_smr_text = 1.0 - torch.mean(score)
+            # Row-wise cosine similarity between the aligned and zero-shot features.
+            # All four are already unit-normalized, so it reduces to a dot product per row.
+            loss_smr_image = 1.0 - (image_features * image_features_zs).sum(-1).mean()
+            loss_smr_text = 1.0 - (text_features * self.text_features_zs_n).sum(-1).mean()
 
-            loss_cmr = F.cross_entropy(logits, label)
+            # log-softmax is always reduced in fp32, whatever precision the logits come in
+            loss_cmr = F.cross_entropy(logits.float(), label)
             
-            loss = loss_cmr + self.w*(loss_smr_image + loss_smr_text)
+            loss = torch.add(loss_cmr, loss_smr_image + loss_smr_text, alpha=self.w)
             # loss = F.cross_entropy(logits, label)
 
             return logits, loss
@@ -721,7 +738,7 @@ class CustomCLIP(nn.Module):
 @TRAINER_REGISTRY.register()
 class DAM(TrainerX):
     def check_cfg(self, cfg):
-        assert cfg.TRAINER.DAM.PREC in ["fp16", "fp32", "amp"]
+        assert cfg.TRAINER.DAM.PREC in ["fp16", "fp32", "amp", "bf16"]
 
     def build_model(self):
         cfg = self.cfg
@@ -729,25 +746,26 @@ class DAM(TrainerX):
         self.n_class = len(self.dm.dataset.classnames)
 
         print(f"Loading CLIP (backbone: {cfg.MODEL.BACKBONE.NAME})")
-        clip_model = load_clip_to_cpu(cfg).cuda()
+        clip_model = load_clip_to_cpu(cfg)
 
-        if cfg.TRAINER.DAM.PREC == "fp32" or cfg.TRAINER.DAM.PREC == "amp":
-            # CLIP's default precision is fp16
+        if cfg.TRAINER.DAM.PREC in ["fp32", "amp", "bf16"]:
+            # CLIP's default precision is fp16; cast on CPU so the weights are copied to GPU only once.
+            # Like "amp", "bf16" keeps fp32 weights (so the prompts are updated in fp32) and only computes
+            # in bf16 under autocast, which needs no loss scaling (requires an Ampere or newer GPU).
             clip_model.float()
+        clip_model = clip_model.cuda()
 
         print("Building custom CLIP")
         self.model = CustomCLIP(cfg, classnames, clip_model)
 
         print("Turning off gradients in both the image and the text encoder")
 
+        # turn off gradients and collect the parameters to be updated in a single pass
+        enabled = set()
         for name, param in self.model.named_parameters():
             if "prompt_learner" not in name and "cma" not in name and "sma" not in name:
                 param.requires_grad_(False)
-
-        # Double check
-        enabled = set()
-        for name, param in self.model.named_parameters():
-            if param.requires_grad:
+            elif param.requires_grad:
                 enabled.add(name)
         print(f"Parameters to be updated: {enabled}")
 
@@ -755,6 +773,14 @@ class DAM(TrainerX):
             load_pretrained_weights(self.model, cfg.MODEL.INIT_WEIGHTS)
 
         self.model.to(self.device)
+        # The patch embedding (conv1) is the only convolution; channels_last lets it use NHWC tensor-core kernels.
+        # It is applied to conv1 alone, since the model's other 4-D tensors (prompt buffers etc.) must stay row-major.
+        self.model.vision_prompt_learner.conv1.to(memory_format=torch.channels_last)
+
+        if cfg.TRAINER.DAM.COMPILE:
+            # Compile in place, so parameter names (and checkpoints) are unchanged.
+            # The number of categories changes between datasets in XD tasks.
+            self.model.compile(mode="reduce-overhead", dynamic=cfg.XD)
 
         self.optim = build_optimizer(self.model, cfg.OPTIM)
         self.sched = build_lr_scheduler(self.optim, cfg.OPTIM)
@@ -762,30 +788,71 @@ class DAM(TrainerX):
 
         self.scaler = GradScaler() if cfg.TRAINER.DAM.PREC == "amp" else None
 
+        # running sums of (loss, acc) on device over the current epoch
+        self._summary_sum = None
+        self._summary_cnt = 0
+
     def forward_backward(self, batch):
         image1, image2, label = self.parse_batch_train(batch)
 
+        # CustomCLIP.forward already runs its encoders under autocast when PREC is "amp" or "bf16"
         logits, loss = self.model(image1, image2, label)
 
-        self.model_backward_and_update(loss)
+        self.optim.zero_grad(set_to_none=True)
+        if self.cfg.TRAINER.DAM.PREC == "amp":
+            self.scaler.scale(loss).backward()
+            self.scaler.unscale_(self.optim)
+            self.scaler.step(self.optim)
+            self.scaler.update()
+        else:
+            loss.backward()
+            self.optim.step()
+
+        # Loss and accuracy are accumulated on device and only synchronized when dassl prints them
+        # (or at the end of the epoch), instead of calling .item() on every step.
+        # The sums cover the whole epoch, so the reported values are epoch averages so far.
+        summary = torch.cat([loss.detach().float().view(1), compute_accuracy(logits.detach(), label)[0].float().view(1)])
+        if self.batch_idx == 0:
+            self._summary_sum, self._summary_cnt = None, 0
+        self._summary_sum = summary if self._summary_sum is None else self._summary_sum + summary
+        self._summary_cnt += 1
+
+        meet_freq = (self.batch_idx + 1) % self.cfg.TRAIN.PRINT_FREQ == 0
+        only_few_batches = self.num_batches < self.cfg.TRAIN.PRINT_FREQ
+        if not (meet_freq or only_few_batches or (self.batch_idx + 1) == self.num_batches):
+            return {}
+
+        loss_avg, acc_avg = (self._summary_sum / self._summary_cnt).tolist()
+        if not math.isfinite(loss_avg):
+            raise FloatingPointError("Loss is infinite or NaN!")
 
         loss_summary = {
-            "loss": loss.item(),
-            "acc": compute_accuracy(logits, label)[0].item(),
+            "loss": loss_avg,
+            "acc": acc_avg,
         }
 
-        if (self.batch_idx + 1) == self.num_batches:
-            self.update_lr()
-
         return loss_summary
 
+    def after_epoch(self):
+        self.update_lr()
+        super().after_epoch()
+
     def parse_batch_train(self, batch):
         input = batch["img"]
-        image1, image2 = input[0], input[1]
+        if isinstance(input, (list, tuple)):
+            image1, image2 = input[0], input[1]
+        else:
+            # a single augmented view
+            image1, image2 = input, None
+        if image2 is not None and image2.data_ptr() == image1.data_ptr():
+            # both views are the same tensor; CustomCLIP falls back to image1 when image2 is None
+            image2 = None
         label = batch["label"]
-        image1 = image1.to(self.device)
-        image2 = image2.to(self.device)
-        label = label.to(self.device)
+        # dassl's data loaders pin host memory, so the copies can overlap with the previous step
+        image1 = image1.to(self.device, non_blocking=True, memory_format=torch.channels_last)
+        if image2 is not None:
+            image2 = image2.to(self.device, non_blocking=True, memory_format=torch.channels_last)
+        label = label.to(self.device, non_blocking=True)
         return image1, image2, label
 
     def load_model(self, directory, epoch=None):
@@ -807,10 +874,22 @@ class DAM(TrainerX):
             if not osp.exists(model_path):
                 raise FileNotFoundError('Model not found at "{}"'.format(model_path))
 
-            checkpoint = load_checkpoint(model_path)
+            try:
+                # Memory-map the file so only the tensors read by load_state_dict are paged in (torch>=2.1).
+                # These are trusted local checkpoints whose scheduler state pickles objects, so weights_only is off.
+                checkpoint = torch.load(model_path, map_location="cpu", mmap=True, weights_only=False)
+            except (TypeError, RuntimeError):
+                # older torch without mmap, or a checkpoint not saved in the zipfile format
+                checkpoint = load_checkpoint(model_path)
             state_dict = checkpoint["state_dict"]
             epoch = checkpoint["epoch"]
 
+            # checkpoints saved with per-layer ParameterLists store 'p_uni.0', 'p_uni.1', ...
+            for key in ["prompt_learner.p_uni", "vision_prompt_learner.p_visual"]:
+                legacy = sorted([k for k in state_dict if k.startswith(key + ".")], key=lambda k: int(k.rsplit(".", 1)[1]))
+                if legacy:
+                    state_dict[key] = torch.stack([state_dict.pop(k) for k in legacy])
+
             print("Loading weights to {} " 'from "{}" (epoch = {})'.format(name, model_path, epoch))
             # set strict=False
             self._models[name].load_state_dict(state_dict, strict=False)